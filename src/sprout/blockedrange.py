@@ -1,66 +1,259 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2013  Infrae. All rights reserved.
 # See also LICENSE.txt
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import izip
+
+
 class Ranges:
     """A set of ranges that can be blocked.
 
     Progressively subranges can be removed and the object maintains what
     ranges are left.
+
+    The open ranges are kept sorted and disjoint, as a flat array of
+    boundaries (start, end, start, end, ...). Blocking a subrange only
+    needs to look at the open ranges it overlaps.
     """
     def __init__(self, s, e):
         self._s = s
         self._e = e
-        self._open = [(s, e)]
+        self._bounds = array('l', (s, e))
 
     def block(self, i, j):
-        """Block another subrange.
+        """Block another subrange, i <= j.
         """
-        open = []
-        # XXX could use bisect here to target possibly affected ranges,
-        # which might optimize it for complicated situations
-        for s, e in self._open:
+        bounds = self._bounds
+        # the first open range that can be affected is the one that
+        # ends at or after i
+        k = bisect_left(bounds, i) // 2
+        # no open range starting after j can be affected
+        l = (bisect_right(bounds, j) + 1) // 2
+        affected = []
+        for n in xrange(k, l):
+            s = bounds[2 * n]
+            e = bounds[2 * n + 1]
             # if there is overlap
             #  s..i...j..e
             if s < i < e and s <= j < e:
-                open.append((s, i))
-                open.append((j, e))
+                affected.extend((s, i, j, e))
             # i..s..e..j
             elif i <= s and j >= e:
                 # all wiped out
                 pass
             # s..i...e...j
             elif s < i < e:
-                open.append((s, i))
+                affected.extend((s, i))
             # i...s...j...e
             elif s <= j < e:
-                open.append((j, e))
+                affected.extend((j, e))
+            else:
+                affected.extend((s, e))
+        bounds[2 * k:2 * l] = array('l', affected)
+
+    def blockMany(self, spans):
+        """Block a number of subranges, given as (i, j) tuples.
+
+        This is equivalent to calling block for each span, but the
+        spans are sorted and merged first and then applied to the
+        open ranges in a single pass.
+        """
+        merged = []
+        for i, j in sorted(spans):
+            if merged and i <= merged[-1][1]:
+                if j > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], j)
+            else:
+                merged.append((i, j))
+        if not merged:
+            return
+        bounds = array('l')
+        n = len(merged)
+        p = 0
+        for s, e in self.iterOpen():
+            # skip spans that end before this open range
+            while p < n and merged[p][1] < s:
+                p += 1
+            q = p
+            while q < n and merged[q][0] <= e:
+                i, j = merged[q]
+                q += 1
+                # same cases as in block, with what is left of the
+                # open range carried over to the next span
+                if s < i < e and s <= j < e:
+                    bounds.extend((s, i))
+                    s = j
+                elif i <= s and j >= e:
+                    s = None
+                    break
+                elif s < i < e:
+                    e = i
+                    break
+                elif s <= j < e:
+                    s = j
+            if s is not None:
+                bounds.extend((s, e))
+        self._bounds = bounds
+
+    def isBlocked(self, pos):
+        """True if the position is blocked.
+
+        Positions outside of the ranges are never blocked.
+        """
+        if not self._s <= pos < self._e:
+            return False
+        # inside an open range if the last boundary at or before pos
+        # is a start
+        return not bisect_right(self._bounds, pos) % 2
+
+    def rangeAt(self, pos):
+        """Get the range containing the position, as returned by
+        getRanges.
+
+        Returns None if the position is outside of the ranges.
+        """
+        if not self._s <= pos < self._e:
+            return None
+        bounds = self._bounds
+        k = bisect_right(bounds, pos)
+        if k % 2:
+            return bounds[k - 1], bounds[k], True
+        if k:
+            s = bounds[k - 1]
+        else:
+            s = self._s
+        if k < len(bounds):
+            e = bounds[k]
+        else:
+            e = self._e
+        return s, e, False
+
+    def blockedWithin(self, i, j):
+        """Get the blocked ranges between i and j, clipped to i and j.
+        """
+        i = max(i, self._s)
+        j = min(j, self._e)
+        result = []
+        if i >= j:
+            return result
+        bounds = self._bounds
+        last_e = i
+        for n in xrange(bisect_right(bounds, i) // 2, len(bounds) // 2):
+            s = bounds[2 * n]
+            if s >= j:
+                break
+            if s > last_e:
+                result.append((last_e, s))
+            last_e = max(last_e, bounds[2 * n + 1])
+        if last_e < j:
+            result.append((last_e, j))
+        return result
+
+    def union(self, other):
+        """Get new ranges open where either these or the other ranges
+        are open.
+
+        This combines for instance the scans of the chunks of a larger
+        text. The new ranges cover both.
+        """
+        return self._combine(other, lambda a, b: a or b)
+
+    def intersection(self, other):
+        """Get new ranges open where both these and the other ranges
+        are open.
+
+        This combines the results of independent scans of the same
+        text: what is blocked in either is blocked in the result.
+        """
+        return self._combine(other, lambda a, b: a and b)
+
+    def difference(self, other):
+        """Get new ranges open where these ranges are open but the
+        other ranges are not.
+        """
+        return self._combine(other, lambda a, b: a and not b)
+
+    def complement(self):
+        """Get new ranges where what is blocked is open and the other
+        way around.
+        """
+        return self.__class__(self._s, self._e).difference(self)
+
+    def _combine(self, other, keep):
+        # sweep through the boundaries of both, keeping the positions
+        # for which keep(open in self, open in other) is true
+        result = self.__class__(min(self._s, other._s),
+                                max(self._e, other._e))
+        a = self._bounds
+        b = other._bounds
+        na = len(a)
+        nb = len(b)
+        i = j = 0
+        bounds = array('l')
+        inside = False
+        while i < na or j < nb:
+            if j >= nb or (i < na and a[i] <= b[j]):
+                pos = a[i]
             else:
-                open.append((s, e))
-        self._open = open
+                pos = b[j]
+            while i < na and a[i] == pos:
+                i += 1
+            while j < nb and b[j] == pos:
+                j += 1
+            # past a start boundary when an odd number was seen
+            now = bool(keep(i % 2, j % 2))
+            if now != inside:
+                bounds.append(pos)
+                inside = now
+        result._bounds = bounds
+        return result
+
+    def iterOpen(self):
+        """Iterate over all ranges that are still open.
+        """
+        i = iter(self._bounds)
+        return izip(i, i)
+
+    def iterBlocked(self):
+        """Iterate over all the ranges that are blocked.
+        """
+        last_e = self._s
+        for s, e in self.iterOpen():
+            if last_e != s:
+                yield last_e, s
+            last_e = e
+        if last_e != self._e:
+            yield last_e, self._e
+
+    def iterRanges(self):
+        """Iterate over all ranges, with a third element indicating
+        blocked status.
+
+        True if open.
+        """
+        last_e = self._s
+        for s, e in self.iterOpen():
+            if last_e != s:
+                yield last_e, s, False
+            yield s, e, True
+            last_e = e
+        if last_e != self._e:
+            yield last_e, self._e, False
 
     def getOpenRanges(self):
         """Get all ranges that are still open.
         """
-        return self._open
+        return list(self.iterOpen())
 
     def getBlockedRanges(self):
         """Get all the ranges that are blocked.
         """
-        return [r[:2] for r in self.getRanges() if not r[2]]
+        return list(self.iterBlocked())
 
     def getRanges(self):
         """Get all ranges, with a third element indicating blocked status.
 
         True if open.
         """
-        ranges = []
-        last_e = self._s
-        e = 0
-        for s, e in self._open:
-            if last_e != s:
-                ranges.append((last_e, s, False))
-            ranges.append((s, e, True))
-            last_e = e
-        if e != self._e:
-            ranges.append((e, self._e, False))
-        return ranges
+        return list(self.iterRanges())
@@ -5,6 +5,9 @@ from sprout.saxext.generator import XMLGenerator
 from sprout.saxext import html2sax
 import sys
 
+class _LimitReached(Exception):
+    pass
+
 class HTMLLimiter(XMLGenerator):
     """Fix (potentially unwellformed) HTML and limit the length of the text
         displayed.
@@ -28,7 +31,17 @@ class HTMLLimiter(XMLGenerator):
         """
         self.maxlength = maxlength
         self._working = True
-        html2sax.saxify(html, self)
+        try:
+            html2sax.saxify(html, self)
+        except _LimitReached:
+            # nothing more is displayed, stop parsing and only close
+            # the elements that are still open
+            while self._stack:
+                name, qname = self._stack.pop()
+                XMLGenerator.endElementNS(self, name, qname)
+        else:
+            # write text that comes after the last element
+            self.flush()
 
     def startElementNS(self, name, qname, attrs):
         """Start element
@@ -39,13 +52,15 @@ class HTMLLimiter(XMLGenerator):
         """
         self.flush()
         if not self._working:
-            return
+            raise _LimitReached()
         self._stack.append((name, qname))
         XMLGenerator.startElementNS(self, name, qname, attrs)
 
     def endElementNS(self, name, qname):
         """End element"""
         self.flush()
+        if not self._working:
+            raise _LimitReached()
         if not self._stack[-1] == (name, qname):
             return
         self._stack.pop()
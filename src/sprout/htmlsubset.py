@@ -12,8 +12,19 @@ tags, not opening or closing a tag, or malformed tags. The parser in
 that case 'does its best' to produce a sane DOM tree.
 """
 
+import copy
+import hashlib
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from HTMLParser import HTMLParser
+from HTMLParser import attrfind as parser_attrfind
+from HTMLParser import tagfind as parser_tagfind
+from StringIO import StringIO
+
 from sprout import tagfilter
-from sprout.saxext import xmlimport, html2sax, collapser
+from sprout.workers import mapInWorkers
+from sprout.saxext import xmlimport, html2sax, generator
 try:
     set
 except NameError:
@@ -27,6 +38,13 @@ class Subset:
         self._elements = {}
         self._tagfilter = tagfilter.TagFilter(html_entities=True)
         self._importer_dict = {}
+        # importer, options and settings shared by all parses, made
+        # when needed
+        self._dispatch = None
+        # unique to this subset and its elements, made again each time
+        # an element is registered, so that parse caches can be shared
+        self._version = object()
+        self._cache = None
 
     def registerElement(self, element):
         self._elements[element.getName()] = element
@@ -35,29 +53,635 @@ class Subset:
             element.getRequiredAttributes(),
             element.getOptionalAttributes())
         self._importer_dict[(None, element.getName())] = element.getHandler()
+        self._dispatch = None
+        self._version = object()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # made again after unpickling, when needed
+        state['_dispatch'] = None
+        state['_cache'] = None
+        return state
+
+    def getSpec(self):
+        """Get the definition of the subset as a spec for
+        subsetFromSpec, that can be saved as JSON.
+        """
+        elements = []
+        for name in sorted(self._elements):
+            element = self._elements[name]
+            handler = element.getHandler()
+            elements.append({
+                    'name': name,
+                    'required_attributes':
+                        list(element.getRequiredAttributes()),
+                    'optional_attributes':
+                        list(element.getOptionalAttributes()),
+                    'subelements': sorted(element.getSubelements()),
+                    'handler': '%s.%s' % (
+                        handler.__module__, handler.__name__)})
+        return {'elements': elements}
+
+    def freeze(self):
+        """Get a FrozenSubset with the elements of this subset.
+        """
+        return FrozenSubset(self)
+
+    def _getDispatch(self):
+        dispatch = self._dispatch
+        if dispatch is None:
+            importer = xmlimport.Importer(self._importer_dict)
+            options = importer.getOptions({'ignore_not_allowed': True})
+            # all the (container, element) pairs that are allowed, so
+            # that checking one is a single lookup
+            allowed = frozenset([
+                    (container_name, name)
+                    for container_name, element in self._elements.items()
+                    for name in element.getSubelements()])
+            settings = SubsetSettings(allowed)
+            dispatch = self._dispatch = importer, options, settings
+        return dispatch
 
     def getImporter(self):
-        return xmlimport.Importer(self._importer_dict)
+        return self._getDispatch()[0]
 
     def isAllowed(self, container_name, name):
-        element = self._elements.get(container_name)
-        if element is None:
-            return False
-        return element.isAllowed(name)
+        return self._getDispatch()[2].isElementAllowed(container_name, name)
+
+    def check(self, html):
+        """Check whether html is valid for the subset as it is.
+
+        It is if all its tags and entities are known to the subset,
+        the elements are allowed where they are and properly nested.
+        Returns None if it is, or else the position at which it stops
+        being valid. Checking stops there.
+        """
+        if html2sax.isplaintext(html):
+            return None
+        settings = self._getDispatch()[2]
+        containers = ['block']
+        for start, end, kind in self._tagfilter.iterScan(html):
+            if kind == tagfilter.TEXT:
+                found = [i for i in (html.find('<', start, end),
+                                     html.find('&', start, end))
+                         if i != -1]
+                if found:
+                    return min(found)
+                continue
+            if kind == tagfilter.ENTITY:
+                continue
+            if html.startswith('</', start):
+                name = html[start + 2:end - 1].lower()
+                if len(containers) == 1 or containers[-1] != name:
+                    return start
+                containers.pop()
+                continue
+            tag = parseStartTag(html, start, end)
+            if tag is None:
+                return start
+            name, closed = tag
+            if not settings.isElementAllowed(containers[-1], name):
+                return start
+            if not closed:
+                containers.append(name)
+        if len(containers) > 1:
+            # elements left open
+            return len(html)
+        return None
+
+    def isClean(self, html):
+        """True if html is valid for the subset as it is.
+        """
+        return self.check(html) is None
+
+    def setCache(self, cache):
+        """Cache the results of filteredParse in a ParseCache.
+
+        None stops caching.
+        """
+        self._cache = cache
+
+    def getCache(self):
+        return self._cache
+
+    def filteredParse(self, html, result, pool=None):
+        cache = self._cache
+        if cache is not None:
+            key = self._getCacheKey(html)
+            events = cache.get(key)
+            if events is not None:
+                handler = self._getHandler(result)
+                replayEvents(events, handler)
+                return handler.result()
+        if not html2sax.isplaintext(html):
+            html = self._tagfilter.escapeNonElements(html, pool)
+        # plain text would only be escaped to be unescaped by parse
+        if cache is None:
+            return self.parse(html, result)
+        handler = self._getHandler(result)
+        recorder = EventRecorder(handler)
+        self._sendEvents(html, recorder)
+        cache.set(key, recorder.getEvents(), len(html))
+        return handler.result()
 
-    def filteredParse(self, html, result):
-        html = self._tagfilter.escapeNonElements(html)
-        return self.parse(html, result)
+    def _getCacheKey(self, html):
+        is_unicode = isinstance(html, unicode)
+        if is_unicode:
+            digest = hashlib.sha1(html.encode('utf-8')).digest()
+        else:
+            digest = hashlib.sha1(html).digest()
+        # results of another subset, or of an older set of elements,
+        # are never used
+        return self._version, is_unicode, digest
+
+    def parseMany(self, inputs, factory=None, workers=None, chunksize=100,
+                  serial_limit=1000):
+        """Filter and parse many inputs, yielding a (result, error)
+        tuple for each of them in order.
+
+        Without a factory, the result is the XML returned by
+        filteredParseToString. With one, it is a result object made by
+        calling factory, built as filteredParse does. If an input
+        fails, the error is the exception it raised and the result is
+        None.
+
+        With workers, the inputs are filtered and parsed in a pool of
+        that many processes, to which this subset is sent only once, as
+        done by sprout.workers.mapInWorkers.
+        """
+        records = factory is not None
+        for result, error in mapInWorkers(
+            _parseInput, (self, records), inputs, workers, chunksize,
+            serial_limit):
+            if error is None and records:
+                # the events of the parse are sent back, as results
+                # built by the handlers cannot be
+                try:
+                    handler = self._getHandler(factory())
+                    replayEvents(result, handler)
+                    result = handler.result()
+                except Exception, error:
+                    result = None
+            yield result, error
+
+    def _recordFilteredParse(self, html):
+        if not html2sax.isplaintext(html):
+            html = self._tagfilter.escapeNonElements(html)
+        recorder = EventRecorder()
+        self._sendEvents(html, recorder)
+        return recorder.getEvents()
 
     def parse(self, html, result):
-        importer = self.getImporter()
-        handler = importer.importHandler(SubsetSettings(self), result)
-        collapsing_handler = collapser.CollapsingHandler(handler)
-        collapsing_handler.startElementNS((None, 'block'), None, {})
-        html2sax.saxify(html, collapsing_handler)
-        collapsing_handler.endElementNS((None, 'block'), None)
+        handler = self._getHandler(result)
+        self._sendEvents(html, handler)
         return handler.result()
 
+    def parseToStream(self, html, out, encoding='UTF-8'):
+        """Parse html and write the allowed elements and text as XML
+        to out, without going through the element handlers.
+
+        The block element itself is not written.
+        """
+        settings = self._getDispatch()[2]
+        writer = generator.XMLGenerator(out, encoding)
+        self._sendEvents(html, SubsetFilter(writer, settings))
+
+    def parseToString(self, html):
+        """Parse html and return the allowed elements and text as XML.
+        """
+        out = StringIO()
+        self.parseToStream(html, out, None)
+        return out.getvalue()
+
+    def filteredParseToStream(self, html, out, encoding='UTF-8', pool=None):
+        if not html2sax.isplaintext(html):
+            html = self._tagfilter.escapeNonElements(html, pool)
+        self.parseToStream(html, out, encoding)
+
+    def filteredParseToString(self, html, pool=None):
+        if not html2sax.isplaintext(html):
+            html = self._tagfilter.escapeNonElements(html, pool)
+        return self.parseToString(html)
+
+    def filteredParseBlocks(self, html):
+        """Filter and parse html, keeping the result as ParsedBlocks.
+
+        Once edited, the text can be parsed again with updateBlocks,
+        and a result built with replayBlocks.
+        """
+        starts = []
+        events = []
+        for block_end in self._parseBlocks(html, 0, starts, events):
+            pass
+        return ParsedBlocks(html, self._version, starts, events)
+
+    def updateBlocks(self, parsed, start, end, text):
+        """Replace what is between start and end in the text of the
+        ParsedBlocks with text, and return new ParsedBlocks for it.
+
+        Only the top-level blocks that the change can affect are
+        filtered and parsed again, the others are reused.
+
+        Raises ValueError unless 0 <= start <= end <= len(parsed.html).
+        """
+        old = parsed.html
+        if not 0 <= start <= end <= len(old):
+            raise ValueError(
+                "Edit from %s to %s is not within the text of length %s" % (
+                    start, end, len(old)))
+        html = old[:start] + text + old[end:]
+        if parsed._version != self._version:
+            return self.filteredParseBlocks(html)
+        old_starts = parsed._starts
+        # the blocks that end before the change are left as they are
+        k = max(bisect_right(old_starts, start) - 1, 0)
+        starts = old_starts[:k]
+        events = parsed._events[:k]
+        if k < len(old_starts):
+            pos = old_starts[k]
+        else:
+            pos = len(old)
+        delta = len(text) - (end - start)
+        # once a block ends after the change where an old block
+        # started, the old blocks that follow can be reused
+        limit = start + len(text)
+        for block_end in self._parseBlocks(html, pos, starts, events):
+            if block_end < limit:
+                continue
+            i = bisect_left(old_starts, block_end - delta)
+            if i < len(old_starts) and old_starts[i] == block_end - delta:
+                starts.extend([s + delta for s in old_starts[i:]])
+                events.extend(parsed._events[i:])
+                break
+        return ParsedBlocks(html, self._version, starts, events)
+
+    def replayBlocks(self, parsed, result):
+        """Build the result of ParsedBlocks, as filteredParse does.
+        """
+        handler = self._getHandler(result)
+        handler.startElementNS((None, 'block'), None, {})
+        for block_events in parsed._events:
+            replayEvents(block_events, handler)
+        handler.endElementNS((None, 'block'), None)
+        return handler.result()
+
+    def _parseBlocks(self, html, pos, starts, events):
+        # filter and parse the blocks of html from pos one by one,
+        # yielding the end of each so that the caller can stop
+        if pos:
+            html = html[pos:]
+        last = 0
+        for block_end in self._iterBlockEnds(html):
+            self._parseBlock(html[last:block_end], pos + last, starts, events)
+            last = block_end
+            yield pos + last
+        if last < len(html):
+            self._parseBlock(html[last:], pos + last, starts, events)
+            yield pos + len(html)
+
+    def _parseBlock(self, html, pos, starts, events):
+        if not html2sax.isplaintext(html):
+            html = self._tagfilter.escapeNonElements(html)
+        recorder = EventRecorder()
+        self._sendContent(html, recorder)
+        starts.append(pos)
+        events.append(recorder.getEvents())
+
+    def _iterBlockEnds(self, html):
+        # a top-level block ends after a tag that leaves no element
+        # open, as the parser would see them after the tag filter
+        open_names = []
+        for start, end, kind in self._tagfilter.iterScan(html):
+            if kind == tagfilter.TEXT:
+                i = html.find('<', start, end)
+                while i != -1:
+                    if html[i + 1:i + 2].isalpha():
+                        # this could start a tag running past any
+                        # block end after it, once text is added there
+                        return
+                    i = html.find('<', i + 1, end)
+                continue
+            if kind != tagfilter.TAG:
+                continue
+            if html.startswith('</', start):
+                name = html[start + 2:end - 1].lower()
+                if name not in open_names:
+                    # ignored by the parser
+                    continue
+                del open_names[
+                    len(open_names) - open_names[::-1].index(name) - 1:]
+            else:
+                tag = parseStartTag(html, start, end)
+                if tag is None:
+                    # not taken as a tag by the parser, keep the rest
+                    # as one block
+                    return
+                name, closed = tag
+                if name in HTMLParser.CDATA_CONTENT_ELEMENTS:
+                    # its content is not parsed
+                    return
+                if not closed:
+                    open_names.append(name)
+            if not open_names and html.find('<', start + 1, end) == -1:
+                # no tag can be found inside of this one either
+                yield end
+
+    def _getHandler(self, result):
+        importer, options, settings = self._getDispatch()
+        return importer.importHandler(result, options, settings)
+
+    def _sendEvents(self, html, handler):
+        handler.startElementNS((None, 'block'), None, {})
+        self._sendContent(html, handler)
+        handler.endElementNS((None, 'block'), None)
+
+    def _sendContent(self, html, handler):
+        if html2sax.isplaintext(html):
+            # a single block of text, nothing to collapse
+            if html:
+                handler.characters(html)
+        else:
+            pipeline = PipelineHandler(handler)
+            parser = html2sax.Html2SaxParser(pipeline, fix_tags=False)
+            parser.feed(html)
+            parser.close()
+            pipeline.flush()
+
+def _parseInput((subset, records), html):
+    try:
+        if records:
+            return subset._recordFilteredParse(html), None
+        return subset.filteredParseToString(html), None
+    except Exception, error:
+        return None, error
+
+def parseStartTag(html, start, end):
+    """Parse the start tag found by the tag filter between start and
+    end as the parser does.
+
+    Returns the name of the element and whether it is closed right
+    away, or None if the parser would not take it as a start tag, such
+    as the end of a tag found inside another one.
+    """
+    if html[start] != '<':
+        return None
+    tag = parser_tagfind.match(html, start + 1)
+    if tag is None:
+        return None
+    i = tag.end()
+    while i < end:
+        attribute = parser_attrfind.match(html, i)
+        if attribute is None:
+            break
+        i = attribute.end()
+    close = html[i:end].strip()
+    if close not in ('>', '/>'):
+        return None
+    name = tag.group(1).lower()
+    return name, close == '/>' or name in html2sax.IMMEDIATE_CLOSE_TAGS
+
+class FrozenSubset(Subset):
+    """A subset of which the elements can no longer change.
+
+    Everything a parse needs is made as it is created or unpickled, so
+    that it is not done by each process it is used in, and can be
+    shared by processes forked after that.
+    """
+
+    def __init__(self, subset):
+        self.__dict__.update(copy.deepcopy(subset.__getstate__()))
+        self._compile()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
+
+    def _compile(self):
+        self._tagfilter.compile()
+        self._getDispatch()
+
+    def registerElement(self, element):
+        raise TypeError("Elements cannot be registered on a FrozenSubset")
+
+    def freeze(self):
+        return self
+
+def subsetFromSpec(spec):
+    """Create a Subset from a spec, as returned by Subset.getSpec.
+
+    The spec is a dictionary with a list of elements. Each element is a
+    dictionary with a name, lists of required_attributes,
+    optional_attributes and subelements, and a handler class or the
+    dotted name of one.
+    """
+    subset = Subset()
+    for element in spec['elements']:
+        handler = element['handler']
+        if isinstance(handler, basestring):
+            module_name, name = handler.rsplit('.', 1)
+            handler = getattr(
+                __import__(module_name, {}, {}, [name]), name)
+        subset.registerElement(Element(
+                element['name'],
+                element.get('required_attributes', []),
+                element.get('optional_attributes', []),
+                element.get('subelements', []),
+                handler))
+    return subset
+
+class PipelineHandler(object):
+    """Fixes tags and collapses text, sending the events directly on.
+
+    This does in a single handler what HtmlTagFixerFilter and
+    CollapsingHandler do together.
+    """
+
+    must_have_end_tags = frozenset(html2sax.MUST_HAVE_END_TAGS)
+
+    def __init__(self, handler):
+        self._handler = handler
+        self._count = 0
+        # the last element started and the count at its start
+        self._last = None
+        self._buffer = []
+
+    def flush(self):
+        if self._buffer:
+            self._handler.characters(''.join(self._buffer))
+            self._buffer = []
+
+    def startElementNS(self, name, qname, attrs):
+        self._last = name, self._count
+        self._count += 1
+        if self._buffer:
+            self.flush()
+        self._handler.startElementNS(name, qname, attrs)
+
+    def endElementNS(self, name, qname):
+        # elements that must have an end tag get some content if
+        # they are empty
+        if (name[1] in self.must_have_end_tags and
+            self._last == (name, self._count - 1)):
+            self._buffer.append(' ')
+        if self._buffer:
+            self.flush()
+        self._handler.endElementNS(name, qname)
+
+    def characters(self, content):
+        self._count += 1
+        self._buffer.append(content)
+
+class SubsetFilter(object):
+    """Sends on the events of the elements that are allowed where they
+    appear, like the importer does with the subset handlers.
+
+    The outer element, the block, is left out.
+    """
+
+    def __init__(self, handler, settings):
+        self._handler = handler
+        self._settings = settings
+        self._containers = []
+        # number of elements open inside the one not allowed
+        self._ignoring = 0
+
+    def startElementNS(self, name, qname, attrs):
+        if self._ignoring:
+            self._ignoring += 1
+            return
+        containers = self._containers
+        if containers and not self._settings.isElementAllowed(
+            containers[-1], name[1]):
+            self._ignoring = 1
+            return
+        containers.append(name[1])
+        if len(containers) > 1:
+            self._handler.startElementNS(name, qname, attrs)
+
+    def endElementNS(self, name, qname):
+        if self._ignoring:
+            self._ignoring -= 1
+            return
+        self._containers.pop()
+        if self._containers:
+            self._handler.endElementNS(name, qname)
+
+    def characters(self, content):
+        if not self._ignoring:
+            self._handler.characters(content)
+
+class EventRecorder(object):
+    """Records the events sent on to a handler, to replay them later
+    with replayEvents.
+
+    Without a handler, the events are only recorded.
+    """
+
+    def __init__(self, handler=None):
+        self._handler = handler
+        self._events = []
+
+    def getEvents(self):
+        return tuple(self._events)
+
+    def startElementNS(self, name, qname, attrs):
+        self._events.append(('startElementNS', (name, qname, attrs)))
+        if self._handler is not None:
+            self._handler.startElementNS(name, qname, attrs)
+
+    def endElementNS(self, name, qname):
+        self._events.append(('endElementNS', (name, qname)))
+        if self._handler is not None:
+            self._handler.endElementNS(name, qname)
+
+    def characters(self, content):
+        self._events.append(('characters', (content,)))
+        if self._handler is not None:
+            self._handler.characters(content)
+
+def replayEvents(events, handler):
+    for method, args in events:
+        getattr(handler, method)(*args)
+
+class ParsedBlocks(object):
+    """A filtered and parsed text, kept as the events of each of its
+    top-level blocks.
+
+    Made by Subset.filteredParseBlocks and Subset.updateBlocks.
+    """
+
+    def __init__(self, html, version, starts, events):
+        self.html = html
+        self._version = version
+        # where each block starts in html and its events
+        self._starts = starts
+        self._events = events
+
+    def __len__(self):
+        return len(self._starts)
+
+class ParseCache(object):
+    """A cache of parse results, used by Subset.filteredParse.
+
+    It keeps at most size results, and if max_memory is given, results
+    for inputs of at most max_memory characters in total. The results
+    used the least recently are evicted first.
+    """
+
+    def __init__(self, size=1000, max_memory=None):
+        self.size = size
+        self.max_memory = max_memory
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            # put it back as the most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def set(self, key, events, weight):
+        if self.max_memory is not None and weight > self.max_memory:
+            return
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.memory -= old[1]
+            self._entries[key] = events, weight
+            self.memory += weight
+            while (len(self._entries) > self.size or
+                   (self.max_memory is not None and
+                    self.memory > self.max_memory)):
+                key, (events, weight) = self._entries.popitem(last=False)
+                self.memory -= weight
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self.memory = 0
+        finally:
+            self._lock.release()
+
 class Element:
     """A single element in a subset.
     """
@@ -82,20 +706,27 @@ class Element:
     def getHandler(self):
         return self._handler
 
+    def getSubelements(self):
+        return self._subelements
+
     def isAllowed(self, name):
         return name in self._subelements
 
-class SubsetSettings(xmlimport.BaseSettings):
-    def __init__(self, subset):
-        super(SubsetSettings, self).__init__(ignore_not_allowed=True)
-        self._subset = subset
+class SubsetSettings(object):
+    """Passed to the handlers of a parse as extra.
+    """
+    def __init__(self, allowed):
+        self._allowed = allowed
 
     def isElementAllowed(self, container_name, name):
-        return self._subset.isAllowed(container_name, name)
+        return (container_name, name) in self._allowed
 
 class SubsetHandler(xmlimport.BaseHandler):
     """A handler that ignores any elements not in subset.
     """
+    def settings(self):
+        return self.getExtra()
+
     def isElementAllowed(self, name):
         return self.settings().isElementAllowed(self.parsed_name, name[1])
 
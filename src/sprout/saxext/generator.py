@@ -179,6 +179,15 @@ def __dict_replace(s, d):
         s = s.replace(key, value)
     return s
 
+def escapetext(data):
+    """Escape &, <, and > in a string of data.
+
+    Data without any of these is returned as it is, without a copy.
+    """
+    # chained str.replace is faster than any single pass in Python
+    return data.replace("&", "&amp;").replace("<", "&lt;").replace(
+        ">", "&gt;")
+
 def escape(data, entities={}):
     """Escape &, <, and > in a string of data.
 
@@ -186,9 +195,7 @@ def escape(data, entities={}):
     the optional entities parameter.  The keys and values must all be
     strings; each key will be replaced with its corresponding value.
     """
-    data = data.replace("&", "&amp;")
-    data = data.replace("<", "&lt;")
-    data = data.replace(">", "&gt;")
+    data = escapetext(data)
     if entities:
         data = __dict_replace(data, entities)
     return data
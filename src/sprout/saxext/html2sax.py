@@ -55,9 +55,16 @@ class Html2SaxParser(HTMLParser):
     """Turn arbitrary HTML events into XML-compliant SAX stream.
     """
 
-    def __init__(self, handler):
+    def __init__(self, handler, fix_tags=True):
+        """Create a parser sending events to the handler.
+
+        If fix_tags is false, the handler is expected to do what
+        HtmlTagFixerFilter does itself.
+        """
         HTMLParser.__init__(self)
-        self._handler = HtmlTagFixerFilter(handler)
+        if fix_tags:
+            handler = HtmlTagFixerFilter(handler)
+        self._handler = handler
         self._stack = []
 
     def _createAttrDict(self, attrs):
@@ -150,7 +157,18 @@ class Html2SaxParser(HTMLParser):
         pass
 
 
+def isplaintext(html):
+    """True if html has no tags or references, so that it is all text.
+    """
+    return '<' not in html and '&' not in html
+
+
 def saxify(html, handler, validate=False):
+    if isplaintext(html):
+        # nothing to parse, send what the parser would have sent
+        if html:
+            handler.characters(html)
+        return
     if validate:
         validator = HTMLParser()
         # This will raise an exception if it cannot process the html
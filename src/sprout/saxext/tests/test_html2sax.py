@@ -65,6 +65,24 @@ class HTML2SaxTestCase(unittest.TestCase):
             'just text',
             makeXML('just text'))
 
+    def test_just_text_events(self):
+        class Recorder:
+            def __init__(self):
+                self.events = []
+            def characters(self, data):
+                self.events.append(data)
+        recorder = Recorder()
+        html2sax.saxify('just > text', recorder)
+        self.assertEquals(['just > text'], recorder.events)
+        recorder = Recorder()
+        html2sax.saxify('', recorder)
+        self.assertEquals([], recorder.events)
+
+    def test_isplaintext(self):
+        self.assertEquals(True, html2sax.isplaintext('just > text'))
+        self.assertEquals(False, html2sax.isplaintext('a <b>'))
+        self.assertEquals(False, html2sax.isplaintext('a &amp; b'))
+
     def test_br(self):
         # br closes right away
         self.assertEquals(
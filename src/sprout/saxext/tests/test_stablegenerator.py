@@ -2,7 +2,7 @@
 # Copyright (c) 2013  Infrae. All rights reserved.
 # See also LICENSE.txt
 import unittest
-from sprout.saxext.generator import XMLGenerator
+from sprout.saxext.generator import XMLGenerator, escape, escapetext
 from StringIO import StringIO
 
 class TestCase(unittest.TestCase):
@@ -207,6 +207,14 @@ class TestCase(unittest.TestCase):
         g.startPrefixMapping(None, uri)
         self.assertRaises(KeyError, g.startElementNS, (None, 'foo'), None,
                           attrs)
+
+    def test_escapetext(self):
+        self.assertEquals('a &lt;b&gt; &amp;amp;',
+                          escapetext('a <b> &amp;'))
+        data = 'nothing to escape'
+        self.assert_(escapetext(data) is data)
+        self.assertEquals('&lt;&quot;&gt;',
+                          escape('<">', {'"': '&quot;'}))
         
 def test_suite():
     suite = unittest.TestSuite()
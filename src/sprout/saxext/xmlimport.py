@@ -201,7 +201,10 @@ class Importer(object):
         return Options(options, self._defaults.copy())
 
     def getMapping(self):
-        return self._mapping.copy()
+        # overrides are pushed on the lists of handlers while importing,
+        # so each import gets its own to use the importer concurrently
+        return dict([(element, list(handlers))
+                     for element, handlers in self._mapping.items()])
 
 
 class _SaxImportHandler(xml.sax.handler.ContentHandler):
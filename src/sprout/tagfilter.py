@@ -2,6 +2,8 @@
 # Copyright (c) 2013  Infrae. All rights reserved.
 # See also LICENSE.txt
 import re
+from array import array
+from itertools import izip, takewhile
 try:
     set
 except NameError:
@@ -9,6 +11,9 @@ except NameError:
 
 from htmlentitydefs import name2codepoint
 from sprout.blockedrange import Ranges
+from sprout.saxext.generator import escapetext
+from sprout.saxext.html2sax import isplaintext
+from sprout.workers import mapInWorkers
 
 start_tag_re = re.compile(r"""
   <[a-zA-Z][-.a-zA-Z0-9:_]*          # tag name
@@ -27,6 +32,48 @@ start_tag_re = re.compile(r"""
   >
 """, re.VERBOSE)
 
+# the attributes and the end of a start tag, following start_tag_re, so
+# that a start tag can be parsed in one go after its name
+attribute_re = re.compile(r"""
+  \s+                                # whitespace before attribute name
+  ([a-zA-Z_][-.:a-zA-Z0-9_]*)        # attribute name
+  (?:\s*=\s*                         # value indicator
+    (?:'[^']*'                       # LITA-enclosed value
+      |\"[^\"]*\"                    # LIT-enclosed value
+      |[^'\">\s]+                    # bare value
+     )
+   )?
+""", re.VERBOSE)
+
+start_tag_close_re = re.compile(r'\s*/?>')
+
+# kinds of spans reported by TagFilter.scan
+TEXT = 0
+TAG = 1
+ENTITY = 2
+
+# entity names are looked up case insensitively
+html_entity_names = frozenset([name.lower() for name in name2codepoint])
+xml_entity_names = frozenset(['amp', 'gt', 'lt'])
+
+# what could still become a tag or an entity when more text is added;
+# this matches more than strictly needed, which is harmless
+incomplete_re = re.compile(r"""
+  (?:&[a-zA-Z0-9]*                   # entity
+    |</[-.a-zA-Z0-9:_]*              # end tag
+    |<(?:[a-zA-Z][-.a-zA-Z0-9:_]*    # start tag
+        (?:\s+[a-zA-Z_][-.:a-zA-Z0-9_]*      # complete attributes
+          (?:\s*=\s*(?:'[^']*'|\"[^\"]*\"|[^'\">\s]+))?
+         )*
+        \s*(?:/                      # start of the end of the tag
+          |[a-zA-Z_][-.:a-zA-Z0-9_]* # or of another attribute
+           (?:\s*(?:=\s*(?:'[^']*|\"[^\"]*|[^'\">\s]*)?)?)?
+         )?
+       )?
+   )
+  \Z
+""", re.VERBOSE)
+
 tagfind = re.compile('[a-zA-Z][-.a-zA-Z0-9:_]*')
 attrfind = re.compile(
     r'\s*([a-zA-Z_][-.:a-zA-Z_0-9]*)(\s*=\s*'
@@ -43,14 +90,17 @@ class TagFilter:
     This right now only supports open tags and closing tags.
     """
 
+    # how many decisions on start tags are remembered
+    decision_cache_size = 1000
+
     def __init__(self, html_entities=False):
         self._elements = {}
         if html_entities:
-            entity_names = ['&%s;' % name for name in name2codepoint.keys()]
+            self._entity_names = html_entity_names
         else:
-            entity_names = ['&amp;', '&gt;', '&lt;']
-        self._entities = re.compile('|'.join(entity_names),
-                                    re.IGNORECASE | re.MULTILINE)
+            self._entity_names = xml_entity_names
+        self._scanner = None
+        self._decisions = {}
 
     def registerElement(self, name,
                         attribute_names=None,
@@ -59,68 +109,238 @@ class TagFilter:
         optional_attribute_names = set(optional_attribute_names or [])
         all_attribute_names = attribute_names.union(optional_attribute_names)
         self._elements[name] = attribute_names, all_attribute_names
+        # recompile the scanner on next use
+        self._scanner = None
+        self._decisions = {}
 
     def getElementNames(self):
         return self._elements.keys()
 
-    def findNonElements(self, s):
+    def compile(self):
+        """Compile the scanner now, instead of on first use.
+        """
+        self._getScanner()
+
+    def _getScanner(self):
+        """Get the scanner for start tags, end tags and entities.
+
+        Returns the compiled expression and a dictionary mapping the
+        name matched in a start tag to the attribute rules to check.
+        """
+        if self._scanner is None:
+            self._scanner = self._compileScanner()
+        return self._scanner
+
+    def _compileScanner(self):
+        # any entity is matched, its name is checked afterwards
+        patterns = ['&(?P<entity>[a-zA-Z][a-zA-Z0-9]*);']
+        start_rules = {}
+        names = sorted(self._elements.keys())
+        if names:
+            alternatives = '|'.join(map(re.escape, names))
+            patterns.append('</(?:%s)>' % alternatives)
+            # the whole tag name must match, not just its beginning
+            patterns.append(
+                '<(?P<start>%s)(?![-.a-zA-Z0-9:_])' % alternatives)
+            for name in names:
+                start_rules.setdefault(name.lower(), []).append(
+                    self._elements[name])
+        scanner = re.compile('|'.join(patterns),
+                             re.IGNORECASE | re.MULTILINE)
+        return scanner, start_rules
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # compiled again after unpickling, when needed
+        state['_scanner'] = None
+        state['_decisions'] = {}
+        return state
+
+    def findNonElements(self, s, pool=None, chunk_size=1000000):
         """Given a string, find returns a Ranges object.
 
         Ranges that are valid tags will be blocked.
+
+        If a pool is given, such as a multiprocessing.Pool, a string
+        longer than chunk_size is split in chunks that are scanned
+        with its map method. The result is the same.
         """
+        if pool is not None and len(s) > chunk_size:
+            return self._findNonElementsChunked(s, pool, chunk_size)
         b = Ranges(0, len(s))
-        for name, (required_attrnames, attrnames) in self._elements.items():
-            # block all start tags
-            q = re.compile('<%s' % name, re.IGNORECASE | re.MULTILINE)
-            i = 0
+        b.blockMany([(i, j) for i, j, kind in self._iterMatches(s)])
+        return b
+
+    def _iterMatches(self, s):
+        """Iterate over the known tags and entities in a string.
+
+        Yields (start, end, kind) tuples, by order of start.
+        """
+        scanner, start_rules = self._getScanner()
+        entity_names = self._entity_names
+        decisions = self._decisions
+        for m in scanner.finditer(s):
+            kind = m.lastgroup
+            if kind is None:
+                # end tag, block it
+                yield m.start(), m.end(), TAG
+                continue
+            if kind == 'entity':
+                if m.group('entity').lower() in entity_names:
+                    yield m.start(), m.end(), ENTITY
+                continue
+            # parse the rest of the start tag, collecting the attribute
+            # names on the way
+            i = m.end()
+            text_attrnames = []
             while 1:
-                m = q.search(s, i)
-                if m is None:
+                a = attribute_re.match(s, i)
+                if a is None:
                     break
-                index = m.start()
-                i = m.end()
-                # find end of pattern and block range for it
-                m = start_tag_re.match(s, index)
-                if m is not None:
-                    # but only if attributes are the same
-                    text_attrnames = set(
-                        self.attribute_names(s, m.start(), m.end()))
-                    # must have all required attribute names and
-                    # be a subset of all possible attribute names
-                    if (required_attrnames.issubset(text_attrnames) and
-                        text_attrnames.issubset(attrnames)):
-                        b.block(m.start(), m.end())
-            # block all end tags
-            q = re.compile('</%s>' % name, re.IGNORECASE | re.MULTILINE)
-            i = 0
-            while 1:
-                m = q.search(s, i)
+                text_attrnames.append(a.group(1).lower())
+                i = a.end()
+            close = start_tag_close_re.match(s, i)
+            if close is None:
+                continue
+            # the same tags tend to come back, remember what was decided
+            key = m.group('start').lower(), tuple(text_attrnames)
+            allowed = decisions.get(key)
+            if allowed is None:
+                allowed = self._isStartTagAllowed(
+                    start_rules[key[0]], set(text_attrnames))
+                if len(decisions) >= self.decision_cache_size:
+                    decisions.clear()
+                decisions[key] = allowed
+            if allowed:
+                yield m.start(), close.end(), TAG
+
+    def scan(self, text):
+        """Find where the known tags and entities are in a text, and
+        the text around them that would be escaped.
+
+        Returns a ScanResult of (start, end, kind) tuples, where kind
+        is TAG, ENTITY or TEXT. A tag or entity found inside another
+        one, such as in an attribute value, is only reported for the
+        part after it.
+        """
+        result = ScanResult()
+        for s, e, kind in self.iterScan(text):
+            result.append(s, e, kind)
+        return result
+
+    def iterScan(self, text):
+        """Iterate over the spans that scan returns, finding them as
+        they are asked for.
+        """
+        last = 0
+        for s, e, kind in self._iterMatches(text):
+            if e <= last:
+                continue
+            if s > last:
+                yield last, s, TEXT
+            else:
+                s = last
+            yield s, e, kind
+            last = e
+        if last < len(text):
+            yield last, len(text), TEXT
+
+    def _isStartTagAllowed(self, rules, text_attrnames):
+        for required_attrnames, attrnames in rules:
+            # must have all required attribute names and
+            # be a subset of all possible attribute names
+            if (required_attrnames.issubset(text_attrnames) and
+                text_attrnames.issubset(attrnames)):
+                return True
+        return False
+
+    def _findNonElementsChunked(self, s, pool, chunk_size):
+        bounds = self._splitText(s, chunk_size)
+        results = pool.map(
+            _findBlockedRanges, [(self, s[i:j]) for i, j in bounds])
+        spans = []
+        for (i, j), blocked in zip(bounds, results):
+            spans.extend([(i + bs, i + be) for bs, be in blocked])
+        b = Ranges(0, len(s))
+        b.blockMany(spans)
+        return b
+
+    def _splitText(self, s, chunk_size):
+        """Split a string in chunks of about chunk_size.
+
+        Returns a list of (start, end) tuples. No tag or entity
+        crosses the end of a chunk.
+        """
+        bounds = []
+        start = 0
+        size = chunk_size
+        while len(s) - start > size:
+            end = start + size
+            # move the end back before anything that is still
+            # incomplete there and could turn out to cross it
+            while end > start:
+                m = incomplete_re.search(s, start, end)
                 if m is None:
                     break
-                index = m.start()
-                i = m.end()
-                b.block(index, i)
-        # block all unknown entities
-        i = 0
-        while 1:
-            m = self._entities.search(s, i)
-            if m is None:
-                break
-            index = m.start()
-            i = m.end()
-            b.block(index, i)
-        return b
+                end = m.start()
+            if end == start:
+                # nothing safe to split on, try a larger chunk
+                size *= 2
+                continue
+            bounds.append((start, end))
+            start = end
+            size = chunk_size
+        bounds.append((start, len(s)))
+        return bounds
+
+    def escapeNonElements(self, text, pool=None, chunk_size=1000000):
+        """Escape what is not a known element.
+
+        The pool and chunk_size are passed to findNonElements.
+        """
+        if isplaintext(text):
+            # no tags or entities to find
+            return escapetext(text)
+        return self._escapeRanges(
+            text,
+            self.findNonElements(text, pool, chunk_size).iterRanges())
+
+    def escapeMany(self, texts, workers=None, chunksize=100,
+                   serial_limit=1000):
+        """Escape many texts, yielding the results in order.
 
-    def escapeNonElements(self, text):
+        With workers, the texts are escaped in a pool of that many
+        processes, to which this filter is sent only once, as done by
+        sprout.workers.mapInWorkers.
+        """
+        return mapInWorkers(
+            _escapeText, self, texts, workers, chunksize, serial_limit)
+
+    def escapeChunks(self, chunks):
+        """Escape text given as an iterable of chunks.
+
+        Yields the escaped text in chunks, which joined together are
+        the same as escapeNonElements of the whole text.
+        """
+        stream = TagFilterStream(self)
+        for chunk in chunks:
+            data = stream.feed(chunk)
+            if data:
+                yield data
+        data = stream.close()
+        if data:
+            yield data
+
+    def _escapeRanges(self, text, ranges):
+        # write all pieces into a single buffer, only open ranges
+        # need to be escaped
         result = []
-        b = self.findNonElements(text)
-        for s, e, open in b.getRanges():
-            subs = text[s:e]
+        append = result.append
+        for s, e, open in ranges:
             if open:
-                subs = subs.replace('&', '&amp;')
-                subs = subs.replace('<', '&lt;')
-                subs = subs.replace('>', '&gt;')
-            result.append(subs)
+                append(escapetext(text[s:e]))
+            else:
+                append(text[s:e])
         return ''.join(result)
 
     def attribute_names(self, rawdata, i, j):
@@ -136,3 +356,79 @@ class TagFilter:
             result.append(attrname.lower())
             k = m.end()
         return result
+
+
+def _findBlockedRanges(args):
+    # scan a chunk of text in a worker of a pool
+    tagfilter, s = args
+    return tagfilter.findNonElements(s).getBlockedRanges()
+
+
+class ScanResult:
+    """The spans found by TagFilter.scan.
+
+    A sequence of (start, end, kind) tuples, stored in a flat array.
+    """
+
+    def __init__(self):
+        self._data = array('l')
+
+    def append(self, start, end, kind):
+        self._data.extend((start, end, kind))
+
+    def __len__(self):
+        return len(self._data) // 3
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        data = self._data
+        return data[3 * index], data[3 * index + 1], data[3 * index + 2]
+
+    def __iter__(self):
+        i = iter(self._data)
+        return izip(i, i, i)
+
+
+def _escapeText(tagfilter, text):
+    return tagfilter.escapeNonElements(text)
+
+
+class TagFilterStream:
+    """Escape text that is not a known element, a chunk at a time.
+
+    Text that could still be part of a tag or an entity is kept until
+    the next chunk arrives, everything before it is escaped and
+    returned.
+    """
+
+    def __init__(self, tagfilter):
+        self._tagfilter = tagfilter
+        self._pending = ''
+
+    def feed(self, chunk):
+        """Feed a chunk of text, returns what could be escaped of it.
+        """
+        text = self._pending + chunk
+        m = incomplete_re.search(text)
+        if m is None:
+            self._pending = ''
+            return self._tagfilter.escapeNonElements(text)
+        end = m.start()
+        b = self._tagfilter.findNonElements(text)
+        # don't split a tag found before what is incomplete
+        s, e, open = b.rangeAt(end)
+        if not open:
+            end = s
+        self._pending = text[end:]
+        return self._tagfilter._escapeRanges(
+            text[:end], takewhile(lambda r: r[0] < end, b.iterRanges()))
+
+    def close(self):
+        """Returns the escaped rest of the text.
+        """
+        text = self._pending
+        self._pending = ''
+        return self._tagfilter.escapeNonElements(text)
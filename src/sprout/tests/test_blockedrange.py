@@ -114,6 +114,135 @@ class BlockedRangesTestCase(unittest.TestCase):
         self.assertEquals([(0, 10, False)],
                            b.getRanges())
 
+    def test_many_blocks_out_of_order(self):
+        b = Ranges(0, 100)
+        for i in [90, 10, 50, 30, 70]:
+            b.block(i, i + 5)
+        self.assertEquals([(0, 10), (15, 30), (35, 50), (55, 70),
+                           (75, 90), (95, 100)],
+                          b.getOpenRanges())
+        b.block(12, 92)
+        self.assertEquals([(0, 10), (95, 100)],
+                          b.getOpenRanges())
+        self.assertEquals([(10, 95)],
+                          b.getBlockedRanges())
+
+    def test_block_touching_ranges(self):
+        b = Ranges(0, 100)
+        b.block(20, 30)
+        b.block(40, 50)
+        b.block(30, 40)
+        self.assertEquals([(0, 20), (50, 100)],
+                          b.getOpenRanges())
+        self.assertEquals([(0, 20, True), (20, 50, False), (50, 100, True)],
+                          b.getRanges())
+
+    def test_block_many(self):
+        b = Ranges(0, 100)
+        b.blockMany([(70, 80), (10, 20), (15, 30), (30, 35), (90, 95)])
+        self.assertEquals([(0, 10), (35, 70), (80, 90), (95, 100)],
+                          b.getOpenRanges())
+        self.assertEquals([(10, 35), (70, 80), (90, 95)],
+                          b.getBlockedRanges())
+
+    def test_block_many_after_block(self):
+        b = Ranges(0, 100)
+        b.block(40, 60)
+        b.blockMany([(30, 45), (55, 65), (50, 52)])
+        self.assertEquals([(0, 30), (65, 100)],
+                          b.getOpenRanges())
+
+    def test_block_many_empty(self):
+        b = Ranges(0, 10)
+        b.blockMany([])
+        self.assertEquals([(0, 10)], b.getOpenRanges())
+
+    def test_iterators(self):
+        b = Ranges(0, 100)
+        b.blockMany([(10, 20), (50, 60)])
+        self.assertEquals([(0, 10), (20, 50), (60, 100)],
+                          list(b.iterOpen()))
+        self.assertEquals([(10, 20), (50, 60)],
+                          list(b.iterBlocked()))
+        self.assertEquals([(0, 10, True), (10, 20, False), (20, 50, True),
+                           (50, 60, False), (60, 100, True)],
+                          list(b.iterRanges()))
+
+    def test_block_all_offset(self):
+        b = Ranges(5, 10)
+        b.block(5, 10)
+        self.assertEquals([],
+                          b.getOpenRanges())
+        self.assertEquals([(5, 10)],
+                          b.getBlockedRanges())
+        self.assertEquals([(5, 10, False)],
+                           b.getRanges())
+
+    def test_is_blocked(self):
+        b = Ranges(0, 100)
+        b.block(10, 20)
+        self.assertEquals(False, b.isBlocked(9))
+        self.assertEquals(True, b.isBlocked(10))
+        self.assertEquals(True, b.isBlocked(19))
+        self.assertEquals(False, b.isBlocked(20))
+        self.assertEquals(False, b.isBlocked(100))
+
+    def test_range_at(self):
+        b = Ranges(0, 100)
+        b.blockMany([(10, 20), (90, 100)])
+        self.assertEquals((0, 10, True), b.rangeAt(0))
+        self.assertEquals((10, 20, False), b.rangeAt(15))
+        self.assertEquals((20, 90, True), b.rangeAt(20))
+        self.assertEquals((90, 100, False), b.rangeAt(99))
+        self.assertEquals(None, b.rangeAt(100))
+        self.assertEquals(None, b.rangeAt(-1))
+
+    def test_blocked_within(self):
+        b = Ranges(0, 100)
+        b.blockMany([(10, 20), (30, 40), (60, 70)])
+        self.assertEquals([(15, 20), (30, 35)],
+                          b.blockedWithin(15, 35))
+        self.assertEquals([],
+                          b.blockedWithin(40, 60))
+        self.assertEquals([(10, 20), (30, 40), (60, 70)],
+                          b.blockedWithin(-10, 200))
+
+    def test_union(self):
+        a = Ranges(0, 50)
+        a.block(10, 20)
+        b = Ranges(50, 100)
+        b.block(60, 70)
+        r = a.union(b)
+        self.assertEquals([(0, 10), (20, 60), (70, 100)],
+                          r.getOpenRanges())
+        self.assertEquals([(10, 20), (60, 70)],
+                          r.getBlockedRanges())
+
+    def test_intersection(self):
+        a = Ranges(0, 100)
+        a.block(10, 20)
+        b = Ranges(0, 100)
+        b.blockMany([(15, 30), (60, 70)])
+        self.assertEquals([(0, 10), (30, 60), (70, 100)],
+                          a.intersection(b).getOpenRanges())
+
+    def test_difference(self):
+        a = Ranges(0, 100)
+        a.block(10, 20)
+        b = Ranges(0, 100)
+        b.block(15, 30)
+        self.assertEquals([(20, 30)],
+                          a.difference(b).getOpenRanges())
+
+    def test_complement(self):
+        b = Ranges(0, 100)
+        b.blockMany([(0, 10), (50, 60)])
+        c = b.complement()
+        self.assertEquals([(0, 10), (50, 60)],
+                          c.getOpenRanges())
+        self.assertEquals(b.getOpenRanges(),
+                          c.getBlockedRanges())
+
 
 def test_suite():
     suite = unittest.TestSuite()
@@ -63,6 +63,40 @@ class HTMLLimitTestCase(unittest.TestCase):
         self.assertEquals(load_testfile('limit_1.html'),
                             makeXML(self.data, 1))
 
+    def test_plain_text(self):
+        self.assertEquals('Just some text',
+                          makeXML('Just some text'))
+        self.assertEquals('Just',
+                          makeXML('Just some text', 4))
+
+    def test_trailing_text(self):
+        self.assertEquals('<b>Bold</b> and more',
+                          makeXML('<b>Bold</b> and more'))
+        self.assertEquals('<b>Bold</b> and',
+                          makeXML('<b>Bold</b> and more', 8))
+
+    def test_nested_same_element(self):
+        self.assertEquals('<p>ab</p>',
+                          makeXML('<p>abc<p>x</p>def</p>', 2))
+        self.assertEquals('<b>abc</b>',
+                          makeXML('<b>abc<b>x</b>y</b>', 3))
+
+    def test_stops_parsing(self):
+        f = StringIO()
+        limit = CountingLimiter(f)
+        limit.parse('<p>Some <b>text</b></p>' * 1000, 6)
+        self.assertEquals('<p>Some <b>t</b></p>', f.getvalue())
+        # parsing stopped at the end of the text reaching the limit
+        self.assertEquals(2, limit.started)
+
+
+class CountingLimiter(htmllimit.HTMLLimiter):
+    started = 0
+
+    def startElementNS(self, name, qname, attrs):
+        self.started += 1
+        htmllimit.HTMLLimiter.startElementNS(self, name, qname, attrs)
+
 
 def test_suite():
     suite = unittest.TestSuite()
@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013  Infrae. All rights reserved.
+# See also LICENSE.txt
+import json
+import pickle
+import threading
+import unittest
+from StringIO import StringIO
+from sprout import htmlsubset, picodom
+
+
+class ElementHandler(htmlsubset.SubsetHandler):
+
+    def startElementNS(self, name, qname, attrs):
+        node = self.parent().ownerDocument.createElement(name[1])
+        for (ns, attr), value in attrs.items():
+            node.setAttribute(attr, value)
+        self.setResult(self.parent().appendChild(node))
+
+    def characters(self, data):
+        node = self.result()
+        node.appendChild(node.ownerDocument.createTextNode(data))
+
+
+class BoldHandler(ElementHandler):
+    parsed_name = 'b'
+
+
+class ItalicHandler(ElementHandler):
+    parsed_name = 'i'
+
+
+class LinkHandler(ElementHandler):
+    parsed_name = 'a'
+
+
+def createSubset():
+    subset = htmlsubset.Subset()
+    subset.registerElement(htmlsubset.Element(
+        'block', [], [], ['b', 'i', 'a'], htmlsubset.BlockHandler))
+    subset.registerElement(htmlsubset.Element(
+        'b', [], [], ['i'], BoldHandler))
+    subset.registerElement(htmlsubset.Element(
+        'i', [], [], [], ItalicHandler))
+    subset.registerElement(htmlsubset.Element(
+        'a', ['href'], ['title'], ['b'], LinkHandler))
+    return subset
+
+
+def createResult():
+    doc = picodom.getDOMImplementation().createDocument(None, 'doc')
+    return doc.documentElement
+
+
+class SubsetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.subset = createSubset()
+
+    def filteredParse(self, html):
+        return self.subset.filteredParse(html, createResult()).toXML()
+
+    def test_simple(self):
+        self.assertEquals(
+            '<doc>hallo <b>Bold</b></doc>',
+            self.filteredParse('hallo <b>Bold</b>'))
+
+    def test_unknown(self):
+        self.assertEquals(
+            '<doc>hallo &lt;u&gt;x&lt;/u&gt; &amp; y</doc>',
+            self.filteredParse('hallo <u>x</u> & y'))
+
+    def test_not_allowed(self):
+        # i is not allowed in i, so it is left out with its contents
+        self.assertEquals(
+            '<doc><b><i>a</i></b><i>b</i></doc>',
+            self.filteredParse('<b><i>a</i></b><i>b<i>c</i></i>'))
+
+    def test_attributes(self):
+        self.assertEquals(
+            '<doc><a href="x">link</a>&lt;a&gt;no link</doc>',
+            self.filteredParse('<a href="x">link</a><a>no link'))
+
+    def test_empty_element(self):
+        # elements that need an end tag get a space as content
+        self.assertEquals(
+            '<doc><b> </b><b><i> </i></b></doc>',
+            self.filteredParse('<b></b><b><i></i></b>'))
+
+    def test_collapsed_text(self):
+        result = self.subset.parse(
+            'a &amp; b &lt; c<b>d &gt; e</b>', createResult())
+        self.assertEquals(2, len(result.childNodes))
+        self.assertEquals(u'a & b < c', result.childNodes[0].data)
+        self.assertEquals(1, len(result.childNodes[1].childNodes))
+
+    def test_plain_text(self):
+        self.assertEquals(
+            '<doc>just some text &gt; more text</doc>',
+            self.filteredParse('just some text > more text'))
+        self.assertEquals(
+            '<doc></doc>',
+            self.filteredParse(''))
+
+    def test_is_allowed(self):
+        self.assert_(self.subset.isAllowed('block', 'b'))
+        self.assert_(self.subset.isAllowed('b', 'i'))
+        self.assert_(not self.subset.isAllowed('i', 'i'))
+        self.assert_(not self.subset.isAllowed('block', 'block'))
+        self.assert_(not self.subset.isAllowed('u', 'b'))
+        self.subset.registerElement(htmlsubset.Element(
+            'u', [], [], ['b'], ElementHandler))
+        self.assert_(self.subset.isAllowed('u', 'b'))
+
+    def test_importer_reused(self):
+        importer = self.subset.getImporter()
+        self.filteredParse('<b>a</b>')
+        self.assert_(importer is self.subset.getImporter())
+        # registering an element makes a new one
+        self.subset.registerElement(htmlsubset.Element(
+            'u', [], [], [], ElementHandler))
+        self.assert_(importer is not self.subset.getImporter())
+
+    def test_threads(self):
+        html = '<b>bold <i>italic</i></b> and <a href="x">link</a>'
+        expected = self.filteredParse(html)
+        results = []
+
+        def parse():
+            for i in range(50):
+                results.append(self.filteredParse(html))
+
+        threads = [threading.Thread(target=parse) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals([expected] * 200, results)
+
+    def test_parse_to_string(self):
+        self.assertEquals(
+            'hallo <b>Bold <i>x</i></b> &lt;u&gt;y&lt;/u&gt;',
+            self.subset.filteredParseToString(
+                'hallo <b>Bold <i>x</i></b> <u>y</u>'))
+        # not allowed elements are left out with their contents
+        self.assertEquals(
+            '<b><i>a</i></b><i>b</i>',
+            self.subset.parseToString('<b><i>a</i></b><i>b<i>c</i></i>'))
+        self.assertEquals(
+            '<a href="x" title="t">link</a>',
+            self.subset.parseToString('<a href="x" title="t">link</a>'))
+        self.assertEquals(
+            '<b> </b> &amp; text',
+            self.subset.parseToString('<b></b> &amp; text'))
+        self.assertEquals('', self.subset.parseToString(''))
+
+    def test_parse_to_stream(self):
+        out = StringIO()
+        self.subset.filteredParseToStream(u'caf\xe9 <b>&</b>', out)
+        self.assertEquals('caf\xc3\xa9 <b>&amp;</b>', out.getvalue())
+
+    def test_check(self):
+        self.assertEquals(None, self.subset.check(''))
+        self.assertEquals(None, self.subset.check('just text > more'))
+        self.assertEquals(
+            None,
+            self.subset.check('a &amp; <b>b<i>c</i></b> <a href="x">y</a>'))
+        self.assert_(self.subset.isClean('<b>b</b>'))
+        # text that would be escaped
+        self.assertEquals(2, self.subset.check('a & b'))
+        self.assertEquals(2, self.subset.check('a & b < c'))
+        self.assertEquals(2, self.subset.check('a < b & c'))
+        self.assertEquals(3, self.subset.check('<b><u>x</u></b>'))
+        # not allowed where it is
+        self.assertEquals(3, self.subset.check('<i><b>x</b></i>'))
+        # missing attributes
+        self.assertEquals(0, self.subset.check('<a>y</a>'))
+        # not nested properly
+        self.assertEquals(7, self.subset.check('<b><i>x</b></i>'))
+        self.assertEquals(0, self.subset.check('</b>'))
+        self.assertEquals(4, self.subset.check('<b>x'))
+        # the / is part of the attribute, a is not closed
+        self.assertEquals(
+            3, self.subset.check('<b><a href=x/></b>'))
+        self.assert_(not self.subset.isClean('<b>x'))
+
+
+class SubsetSpecTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.subset = createSubset()
+        self.html = '<b>a <i>b</i></b> & <a href="x" title="y">c</a><u>'
+
+    def test_spec(self):
+        spec = json.loads(json.dumps(self.subset.getSpec()))
+        self.assertEquals(
+            {'name': 'a', 'required_attributes': ['href'],
+             'optional_attributes': ['title'], 'subelements': ['b'],
+             'handler': 'sprout.tests.test_htmlsubset.LinkHandler'},
+            spec['elements'][0])
+        subset = htmlsubset.subsetFromSpec(spec)
+        self.assertEquals(
+            self.subset.filteredParse(self.html, createResult()).toXML(),
+            subset.filteredParse(self.html, createResult()).toXML())
+
+    def test_spec_classes(self):
+        subset = htmlsubset.subsetFromSpec({'elements': [
+                    {'name': 'block', 'subelements': ['b'],
+                     'handler': htmlsubset.BlockHandler},
+                    {'name': 'b', 'handler': BoldHandler}]})
+        self.assertEquals(
+            '<b>a &lt;i&gt;b&lt;/i&gt;</b> &amp; '
+            '&lt;a href="x" title="y"&gt;c&lt;/a&gt;&lt;u&gt;',
+            subset.filteredParseToString(self.html))
+
+    def test_freeze(self):
+        frozen = self.subset.freeze()
+        self.assert_(isinstance(frozen, htmlsubset.FrozenSubset))
+        self.assert_(frozen.freeze() is frozen)
+        self.assertEquals(
+            self.subset.filteredParseToString(self.html),
+            frozen.filteredParseToString(self.html))
+        self.assertRaises(
+            TypeError, frozen.registerElement,
+            htmlsubset.Element('u', [], [], [], ElementHandler))
+        # changing the subset does not change the frozen one
+        self.subset.registerElement(htmlsubset.Element(
+            'block', [], [], [], htmlsubset.BlockHandler))
+        self.assert_(frozen.isAllowed('block', 'b'))
+
+    def test_pickle_frozen(self):
+        frozen = pickle.loads(pickle.dumps(self.subset.freeze(), 2))
+        self.assert_(isinstance(frozen, htmlsubset.FrozenSubset))
+        self.assertEquals(
+            self.subset.filteredParse(self.html, createResult()).toXML(),
+            frozen.filteredParse(self.html, createResult()).toXML())
+
+
+class SubsetManyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.subset = createSubset()
+        self.inputs = ['<b>%d</b> & <i>%d</i><u>' % (i, i) for i in range(30)]
+
+    def test_strings(self):
+        expected = [(self.subset.filteredParseToString(html), None)
+                    for html in self.inputs]
+        self.assertEquals(expected, list(self.subset.parseMany(self.inputs)))
+        self.assertEquals(
+            expected, list(self.subset.parseMany(
+                    iter(self.inputs), workers=2, chunksize=4,
+                    serial_limit=10)))
+
+    def test_factory(self):
+        expected = [self.subset.filteredParse(html, createResult()).toXML()
+                    for html in self.inputs]
+        for options in [{}, {'workers': 2, 'serial_limit': 10}]:
+            results = list(self.subset.parseMany(
+                    self.inputs, createResult, **options))
+            self.assertEquals(
+                expected, [result.toXML() for result, error in results])
+            self.assertEquals([None] * 30, [error for result, error in results])
+
+    def test_errors(self):
+        inputs = ['<b>a</b>', None, 'c']
+        for options in [{}, {'workers': 2, 'serial_limit': 1}]:
+            results = list(self.subset.parseMany(inputs, **options))
+            self.assertEquals(('<b>a</b>', None), results[0])
+            self.assertEquals(None, results[1][0])
+            self.assert_(isinstance(results[1][1], TypeError))
+            self.assertEquals(('c', None), results[2])
+
+    def test_pickle(self):
+        self.subset.setCache(htmlsubset.ParseCache())
+        self.subset.filteredParseToString('<b>a</b>')
+        subset = pickle.loads(pickle.dumps(self.subset))
+        self.assertEquals(None, subset.getCache())
+        self.assertEquals(
+            '<b>a</b>&lt;u&gt;', subset.filteredParseToString('<b>a</b><u>'))
+
+
+class SubsetBlocksTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.subset = createSubset()
+
+    def replay(self, parsed):
+        return self.subset.replayBlocks(parsed, createResult()).toXML()
+
+    def filteredParse(self, html):
+        return self.subset.filteredParse(html, createResult()).toXML()
+
+    def test_blocks(self):
+        html = 'a <b>b <i>c</i></b> & d <i>e</i><a href="x">f</a> <u>g'
+        parsed = self.subset.filteredParseBlocks(html)
+        self.assertEquals(4, len(parsed))
+        self.assertEquals(html, parsed.html)
+        self.assertEquals(self.filteredParse(html), self.replay(parsed))
+        self.assertEquals(
+            '<doc></doc>',
+            self.replay(self.subset.filteredParseBlocks('')))
+
+    def test_update(self):
+        html = '<b>one</b> <i>two</i> <b>three</b>'
+        parsed = self.subset.filteredParseBlocks(html)
+        self.assertEquals(3, len(parsed))
+        updated = self.subset.updateBlocks(parsed, 14, 17, 'TWO & 2 < 3')
+        self.assertEquals(
+            '<b>one</b> <i>TWO & 2 < 3</i> <b>three</b>', updated.html)
+        self.assertEquals(
+            '<doc><b>one</b> <i>TWO &amp; 2 &lt; 3</i> <b>three</b></doc>',
+            self.replay(updated))
+        # the blocks before and after the change are reused
+        self.assertEquals(3, len(updated))
+        self.assert_(updated._events[0] is parsed._events[0])
+        self.assert_(updated._events[2] is parsed._events[2])
+
+    def test_update_bounds(self):
+        parsed = self.subset.filteredParseBlocks('<b>x</b> y')
+        for start, end in [(5, 2), (-1, 2), (2, 11), (11, 11)]:
+            self.assertRaises(
+                ValueError, self.subset.updateBlocks, parsed, start, end, 'Q')
+        self.assertEquals(
+            '<b>x</b> yQ',
+            self.subset.updateBlocks(parsed, 10, 10, 'Q').html)
+
+    def test_update_joins_blocks(self):
+        html = '<b>one</b> <i>two</i> three'
+        parsed = self.subset.filteredParseBlocks(html)
+        # an open element now takes in the following blocks
+        updated = self.subset.updateBlocks(parsed, 0, 10, '<b>one')
+        self.assertEquals(self.filteredParse(updated.html),
+                          self.replay(updated))
+        self.assertEquals(1, len(updated))
+        # and they are split again
+        updated = self.subset.updateBlocks(updated, 6, 6, '</b>')
+        self.assertEquals(html, updated.html)
+        self.assertEquals(self.filteredParse(html), self.replay(updated))
+        self.assertEquals(3, len(updated))
+
+    def test_register_element(self):
+        parsed = self.subset.filteredParseBlocks('<u>x</u> <b>y</b>')
+        self.subset.registerElement(htmlsubset.Element(
+            'u', [], [], [], ElementHandler))
+        self.subset.registerElement(htmlsubset.Element(
+            'block', [], [], ['b', 'u'], htmlsubset.BlockHandler))
+        updated = self.subset.updateBlocks(parsed, 12, 13, 'z')
+        self.assertEquals(
+            '<doc><u>x</u> <b>z</b></doc>', self.replay(updated))
+
+
+class SubsetCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.subset = createSubset()
+        self.cache = htmlsubset.ParseCache(size=2)
+        self.subset.setCache(self.cache)
+
+    def filteredParse(self, html):
+        return self.subset.filteredParse(html, createResult()).toXML()
+
+    def test_hit(self):
+        html = 'hallo <b>Bold <i>x</i></b> <u>y</u>'
+        expected = '<doc>hallo <b>Bold <i>x</i></b> &lt;u&gt;y&lt;/u&gt;</doc>'
+        self.assertEquals(expected, self.filteredParse(html))
+        self.assertEquals((0, 1), (self.cache.hits, self.cache.misses))
+        self.assertEquals(expected, self.filteredParse(html))
+        self.assertEquals((1, 1), (self.cache.hits, self.cache.misses))
+        self.assertEquals(
+            u'<doc>hallo <b>Bold <i>x</i></b> &lt;u&gt;y&lt;/u&gt;</doc>',
+            self.filteredParse(unicode(html)))
+        self.assertEquals((1, 2), (self.cache.hits, self.cache.misses))
+
+    def test_register_element(self):
+        self.assertEquals(
+            '<doc>&lt;u&gt;y&lt;/u&gt;</doc>', self.filteredParse('<u>y</u>'))
+        self.subset.registerElement(htmlsubset.Element(
+            'u', [], [], [], ElementHandler))
+        self.subset.registerElement(htmlsubset.Element(
+            'block', [], [], ['u'], htmlsubset.BlockHandler))
+        self.assertEquals(
+            '<doc><u>y</u></doc>', self.filteredParse('<u>y</u>'))
+        self.assertEquals(0, self.cache.hits)
+
+    def test_shared(self):
+        other = htmlsubset.Subset()
+        other.registerElement(htmlsubset.Element(
+            'block', [], [], ['b', 'i', 'a'], htmlsubset.BlockHandler))
+        other.registerElement(htmlsubset.Element(
+            'b', [], [], ['i'], BoldHandler))
+        other.registerElement(htmlsubset.Element(
+            'i', [], [], [], ItalicHandler))
+        other.registerElement(htmlsubset.Element(
+            'a', ['href'], ['title', 'onclick'], ['b'], LinkHandler))
+        other.setCache(self.cache)
+        html = '<a href="x" onclick="evil()">y</a>'
+        self.assertEquals(
+            '<doc><a href="x" onclick="evil()">y</a></doc>',
+            other.filteredParse(html, createResult()).toXML())
+        # the same number of elements is registered, but the result
+        # of the other subset is not used
+        self.assertEquals(
+            '<doc>&lt;a href="x" onclick="evil()"&gt;y</doc>',
+            self.filteredParse(html))
+        self.assertEquals((0, 2), (self.cache.hits, self.cache.misses))
+
+    def test_eviction(self):
+        self.filteredParse('a')
+        self.filteredParse('<b>b</b>')
+        self.filteredParse('a')
+        self.filteredParse('<i>c</i>')
+        # b was used the least recently
+        self.assertEquals(2, len(self.cache))
+        self.assertEquals(1, self.cache.evictions)
+        self.filteredParse('a')
+        self.assertEquals(2, self.cache.hits)
+        self.filteredParse('<b>b</b>')
+        self.assertEquals(2, self.cache.hits)
+
+    def test_max_memory(self):
+        self.cache = htmlsubset.ParseCache(max_memory=10)
+        self.subset.setCache(self.cache)
+        self.filteredParse('<b>b</b>')
+        self.filteredParse('<i>i</i>')
+        self.assertEquals(1, len(self.cache))
+        self.assertEquals(8, self.cache.memory)
+        # too large to be cached at all
+        self.filteredParse('a very long text')
+        self.assertEquals(1, len(self.cache))
+        self.cache.clear()
+        self.assertEquals(0, len(self.cache))
+        self.assertEquals(0, self.cache.memory)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    for testcase in [SubsetTestCase, SubsetSpecTestCase, SubsetManyTestCase,
+                     SubsetBlocksTestCase, SubsetCacheTestCase]:
+        suite.addTest(unittest.makeSuite(testcase))
+    return suite
@@ -2,7 +2,9 @@
 # Copyright (c) 2013  Infrae. All rights reserved.
 # See also LICENSE.txt
 import unittest
-from sprout.tagfilter import TagFilter
+import multiprocessing
+from sprout.tagfilter import TagFilter, TagFilterStream
+from sprout.tagfilter import TEXT, TAG, ENTITY
 
 
 class TagFilterTestCase(unittest.TestCase):
@@ -122,10 +124,200 @@ class TagFilterTestCase(unittest.TestCase):
             'Hoi<foo a="Dag" />',
             s)
 
+    def test_register_after_use(self):
+        f = TagFilter()
+        f.registerElement('b')
+        s = f.escapeNonElements('<b>Bold</b> <i>Italic</i>')
+        self.assertEquals(
+            '<b>Bold</b> &lt;i&gt;Italic&lt;/i&gt;',
+            s)
+        f.registerElement('i')
+        s = f.escapeNonElements('<b>Bold</b> <i>Italic</i>')
+        self.assertEquals(
+            '<b>Bold</b> <i>Italic</i>',
+            s)
+
+    def test_reregister_after_use(self):
+        f = TagFilter()
+        f.registerElement('a', ['href'])
+        text = '<a href="x" title="y">link</a>'
+        self.assertEquals(
+            '&lt;a href="x" title="y"&gt;link</a>',
+            f.escapeNonElements(text))
+        f.registerElement('a', ['href'], ['title'])
+        self.assertEquals(
+            text,
+            f.escapeNonElements(text))
+
+    def test_decision_cache_size(self):
+        f = TagFilter()
+        f.decision_cache_size = 2
+        f.registerElement('a', ['href'], ['title'])
+        text = '<a href="x"><a title="y"><a href="x" title="y"><a>'
+        for i in range(3):
+            self.assertEquals(
+                '<a href="x">&lt;a title="y"&gt;<a href="x" title="y">'
+                '&lt;a&gt;',
+                f.escapeNonElements(text))
+            self.assert_(len(f._decisions) <= 2)
+
+    def test_scan(self):
+        f = TagFilter()
+        f.registerElement('b')
+        f.registerElement('a', ['href'])
+        result = f.scan('hallo <b>Bold&amp;</b><i> <a href="&lt;">')
+        self.assertEquals(
+            [(0, 6, TEXT), (6, 9, TAG), (9, 13, TEXT), (13, 18, ENTITY),
+             (18, 22, TAG), (22, 26, TEXT), (26, 41, TAG)],
+            list(result))
+        self.assertEquals(7, len(result))
+        self.assertEquals((6, 9, TAG), result[1])
+        self.assertEquals((26, 41, TAG), result[-1])
+        self.assertEquals([], list(f.scan('')))
+
+    def test_iter_scan(self):
+        f = TagFilter()
+        f.registerElement('b')
+        spans = f.iterScan('<b>a</b> <u>')
+        self.assertEquals((0, 3, TAG), spans.next())
+        self.assertEquals((3, 4, TEXT), spans.next())
+        self.assertEquals(
+            [(4, 8, TAG), (8, 12, TEXT)], list(spans))
+
+    def test_plain_text(self):
+        f = TagFilter()
+        f.registerElement('b')
+        text = 'just some text'
+        self.assert_(f.escapeNonElements(text) is text)
+        self.assertEquals('a &gt; b', f.escapeNonElements('a > b'))
+
+    def test_no_elements(self):
+        f = TagFilter()
+        s = f.escapeNonElements('<b>Bold &amp; stuff</b>')
+        self.assertEquals(
+            '&lt;b&gt;Bold &amp; stuff&lt;/b&gt;',
+            s)
+
+    def test_prefix_names(self):
+        f = TagFilter()
+        f.registerElement('b')
+        s = f.escapeNonElements('<b>Bold</b><br><blockquote>Quote')
+        self.assertEquals(
+            '<b>Bold</b>&lt;br&gt;&lt;blockquote&gt;Quote',
+            s)
+
+    def test_prefix_names_registered(self):
+        f = TagFilter()
+        f.registerElement('b')
+        f.registerElement('br', [], ['class'])
+        s = f.escapeNonElements('<b class="x"><br class="x"><b><br>')
+        self.assertEquals(
+            '&lt;b class="x"&gt;<br class="x"><b><br>',
+            s)
+
+    def test_bare_attribute_value(self):
+        f = TagFilter()
+        f.registerElement('a', ['href'])
+        # all attributes are seen, even after an unusual bare value
+        s = f.escapeNonElements('<a href=x@y title=z>')
+        self.assertEquals(
+            '&lt;a href=x@y title=z&gt;',
+            s)
+
+    def test_entities_case(self):
+        f = TagFilter(html_entities=True)
+        s = f.escapeNonElements('&AMP; &Alpha; &ALPHA; &frac12; &alpha1;')
+        self.assertEquals(
+            '&AMP; &Alpha; &ALPHA; &frac12; &amp;alpha1;',
+            s)
+
+
+class TagFilterStreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.filter = TagFilter()
+        self.filter.registerElement('a', ['href'])
+        self.filter.registerElement('b')
+
+    def test_split_tag(self):
+        stream = TagFilterStream(self.filter)
+        self.assertEquals('hallo ', stream.feed('hallo <a hr'))
+        self.assertEquals('<a href="url">', stream.feed('ef="url">'))
+        self.assertEquals('link', stream.feed('link<'))
+        self.assertEquals('</a>', stream.feed('/a>'))
+        self.assertEquals('', stream.close())
+
+    def test_split_entity(self):
+        stream = TagFilterStream(self.filter)
+        self.assertEquals('1 ', stream.feed('1 &am'))
+        self.assertEquals('&amp; 2 ', stream.feed('p; 2 &a'))
+        self.assertEquals('&amp;a', stream.close())
+
+    def test_split_quoted_attribute(self):
+        stream = TagFilterStream(self.filter)
+        self.assertEquals('', stream.feed('<a href="<b>'))
+        self.assertEquals('<a href="<b>">', stream.feed('">'))
+        self.assertEquals('', stream.close())
+
+    def test_escape_chunks(self):
+        text = 'hallo< <b>Bold stu>ff<b><b &foo; <a href="x">y</a>'
+        for size in range(1, 10):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            self.assertEquals(
+                self.filter.escapeNonElements(text),
+                ''.join(self.filter.escapeChunks(chunks)))
+
+
+class SerialPool:
+    def map(self, func, iterable):
+        return map(func, iterable)
+
+
+class TagFilterChunkedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.filter = TagFilter(html_entities=True)
+        self.filter.registerElement('a', ['href'])
+        self.filter.registerElement('b')
+        self.text = ('hallo< <b>Bold stu>ff<b><b &foo; &alpha; '
+                     '<a href="x>y">link</a> <a href="y">')
+
+    def test_split(self):
+        for size in range(1, 20):
+            bounds = self.filter._splitText(self.text, size)
+            self.assertEquals(0, bounds[0][0])
+            self.assertEquals(len(self.text), bounds[-1][1])
+            for (s1, e1), (s2, e2) in zip(bounds, bounds[1:]):
+                self.assertEquals(e1, s2)
+            self.assertEquals(
+                self.filter.findNonElements(self.text).getRanges(),
+                self.filter.findNonElements(
+                    self.text, SerialPool(), size).getRanges())
+
+    def test_pool(self):
+        pool = multiprocessing.Pool(2)
+        try:
+            text = self.text * 100
+            self.assertEquals(
+                self.filter.escapeNonElements(text),
+                self.filter.escapeNonElements(text, pool, 100))
+        finally:
+            pool.terminate()
+
+    def test_escape_many(self):
+        texts = [self.text[i:] for i in range(len(self.text))]
+        expected = [self.filter.escapeNonElements(t) for t in texts]
+        self.assertEquals(
+            expected, list(self.filter.escapeMany(texts)))
+        self.assertEquals(
+            expected, list(self.filter.escapeMany(iter(texts), workers=2)))
+        self.assertEquals(
+            expected, list(self.filter.escapeMany(
+                    iter(texts), workers=2, chunksize=7, serial_limit=10)))
+
 
 def test_suite():
     suite = unittest.TestSuite()
-    for testcase in [TagFilterTestCase]:
+    for testcase in [TagFilterTestCase, TagFilterStreamTestCase,
+                     TagFilterChunkedTestCase]:
         suite.addTest(unittest.makeSuite(testcase))
     return suite
 
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013  Infrae. All rights reserved.
+# See also LICENSE.txt
+import os
+import unittest
+
+from sprout.workers import mapInWorkers
+
+
+def multiply(factor, item):
+    return factor * item, os.getpid()
+
+
+class MapInWorkersTestCase(unittest.TestCase):
+
+    def test_serial(self):
+        results = list(mapInWorkers(multiply, 3, iter(range(10))))
+        self.assertEquals(
+            [i * 3 for i in range(10)], [result for result, pid in results])
+        self.assertEquals(set([os.getpid()]), set(pid for r, pid in results))
+        # below serial_limit no pool is started
+        results = list(mapInWorkers(multiply, 3, range(10), workers=2))
+        self.assertEquals(set([os.getpid()]), set(pid for r, pid in results))
+
+    def test_workers(self):
+        results = list(mapInWorkers(
+                multiply, 3, iter(range(50)), workers=2, chunksize=4,
+                serial_limit=10))
+        self.assertEquals(
+            [i * 3 for i in range(50)], [result for result, pid in results])
+        self.assert_(os.getpid() not in set(pid for r, pid in results))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(MapInWorkersTestCase))
+    return suite
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013  Infrae. All rights reserved.
+# See also LICENSE.txt
+"""Call a function for many items, optionally in a pool of processes.
+"""
+import multiprocessing
+from itertools import chain, islice
+
+
+def mapInWorkers(func, shared, items, workers=None, chunksize=100,
+                 serial_limit=1000):
+    """Call func(shared, item) for each item, yielding the results in
+    order.
+
+    With workers, the calls are made in a pool of that many processes,
+    to which func and shared are sent only once. Items are sent to the
+    workers chunksize at a time. Up to serial_limit items are handled
+    here, as starting a pool costs more.
+
+    func must be defined at module level, so that it can be pickled.
+    """
+    items = iter(items)
+    if workers:
+        head = list(islice(items, serial_limit + 1))
+    else:
+        head = items
+    if not workers or len(head) <= serial_limit:
+        for item in head:
+            yield func(shared, item)
+        return
+    pool = multiprocessing.Pool(workers, _initWorker, (func, shared))
+    try:
+        for result in pool.imap(
+            _callInWorker, chain(head, items), chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+_worker_func = None
+_worker_shared = None
+
+def _initWorker(func, shared):
+    # keep what is sent once to a worker of a pool
+    global _worker_func, _worker_shared
+    _worker_func = func
+    _worker_shared = shared
+
+
+def _callInWorker(item):
+    return _worker_func(_worker_shared, item)